@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Response, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from app.models import (
     UserSignup,
@@ -10,10 +11,17 @@ from app.models import (
     EmailVerification,
 )
 from app.db import get_supabase_client
-from app.auth_dependencies import get_current_user
+from app.auth_dependencies import (
+    get_current_user,
+    get_current_user_full,
+    revoke_token,
+)
 
 # from app.rate_limiter import rate_limiter
 from supabase.client import Client
+from gotrue.errors import AuthError
+from gotrue.helpers import parse_user_response
+from gotrue.types import UserResponse
 from typing import Dict, Any
 import logging
 
@@ -21,18 +29,32 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
 
+def _update_user(client: Client, token: str, attributes: dict) -> UserResponse:
+    """PUT /user as the caller's token, not the client's shared session"""
+    # auth.update_user() acts on whichever session last signed in or
+    # refreshed on the shared client; this is the same request, scoped
+    # to the given token like auth.get_user(jwt). _request is internal,
+    # which is why requirements.txt pins gotrue.
+    return client.auth._request(
+        "PUT", "user", body=attributes, jwt=token, xform=parse_user_response
+    )
+
+
 @router.post("/signup", response_model=AuthResponse)
-async def signup(user_data: UserSignup, request: Request):
+async def signup(
+    user_data: UserSignup,
+    request: Request,
+    client: Client = Depends(get_supabase_client),
+):
     """Register a new user with email and password"""
 
     # Rate limiting
     # await rate_limiter.check_rate_limit(request)
 
     try:
-        client: Client = get_supabase_client()
-
         # Sign up user with Supabase Auth
-        response = client.auth.sign_up(
+        response = await run_in_threadpool(
+            client.auth.sign_up,
             {
                 "email": user_data.email,
                 "password": user_data.password,
@@ -42,7 +64,7 @@ async def signup(user_data: UserSignup, request: Request):
                         "username": user_data.username,
                     }
                 },
-            }
+            },
         )
 
         if response.user is None:
@@ -53,7 +75,7 @@ async def signup(user_data: UserSignup, request: Request):
 
         # Check if email confirmation is required
         if response.session is None:
-            return AuthResponse(
+            return AuthResponse.model_construct(
                 message="Please check your email to confirm your account",
                 user=None,
                 access_token=None,
@@ -61,7 +83,7 @@ async def signup(user_data: UserSignup, request: Request):
                 requires_verification=True,
             )
 
-        return AuthResponse(
+        return AuthResponse.model_construct(
             message="User registered successfully",
             user={
                 "id": response.user.id,
@@ -74,14 +96,16 @@ async def signup(user_data: UserSignup, request: Request):
             requires_verification=False,
         )
 
-    except Exception as e:
-        logger.error(f"Signup error: {e}")
+    except AuthError as e:
+        logger.warning("Signup failed: %s", e)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
 @router.post("/login", response_model=AuthResponse)
 async def login(
-    form_data: OAuth2PasswordRequestForm = Depends(), request: Request = None
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    request: Request = None,
+    client: Client = Depends(get_supabase_client),
 ):
     """Login user with email and password"""
 
@@ -89,14 +113,13 @@ async def login(
     # await rate_limiter.check_rate_limit(request)
 
     try:
-        client: Client = get_supabase_client()
-
         # Sign in with Supabase Auth
-        response = client.auth.sign_in_with_password(
+        response = await run_in_threadpool(
+            client.auth.sign_in_with_password,
             {
                 "email": form_data.username,  # OAuth2 uses username field for email
                 "password": form_data.password,
-            }
+            },
         )
 
         if response.user is None or response.session is None:
@@ -107,7 +130,7 @@ async def login(
         # Get user metadata
         user_metadata = response.user.user_metadata or {}
 
-        return AuthResponse(
+        return AuthResponse.model_construct(
             message="Login successful",
             user={
                 "id": response.user.id,
@@ -120,21 +143,24 @@ async def login(
             requires_verification=False,
         )
 
-    except Exception as e:
-        logger.error(f"Login error: {e}")
+    except AuthError:
+        logger.warning("Login failed for %s", form_data.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials"
         )
 
 
 @router.post("/refresh", response_model=AuthResponse)
-async def refresh_token(refresh_data: Dict[str, str], request: Request):
+async def refresh_token(
+    refresh_data: Dict[str, str],
+    request: Request,
+    client: Client = Depends(get_supabase_client),
+):
     """Refresh access token using refresh token"""
 
     # await rate_limiter.check_rate_limit(request)
 
     try:
-        client: Client = get_supabase_client()
         refresh_token = refresh_data.get("refresh_token")
 
         if not refresh_token:
@@ -143,7 +169,7 @@ async def refresh_token(refresh_data: Dict[str, str], request: Request):
             )
 
         # Refresh session
-        response = client.auth.refresh_session(refresh_token)
+        response = await run_in_threadpool(client.auth.refresh_session, refresh_token)
 
         if response.session is None:
             raise HTTPException(
@@ -152,7 +178,7 @@ async def refresh_token(refresh_data: Dict[str, str], request: Request):
 
         user_metadata = response.user.user_metadata or {}
 
-        return AuthResponse(
+        return AuthResponse.model_construct(
             message="Token refreshed successfully",
             user={
                 "id": response.user.id,
@@ -165,8 +191,8 @@ async def refresh_token(refresh_data: Dict[str, str], request: Request):
             requires_verification=False,
         )
 
-    except Exception as e:
-        logger.error(f"Token refresh error: {e}")
+    except AuthError as e:
+        logger.warning("Token refresh failed: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Token refresh failed"
         )
@@ -174,57 +200,43 @@ async def refresh_token(refresh_data: Dict[str, str], request: Request):
 
 @router.post("/logout")
 async def logout(
-    current_user: Dict[str, Any] = Depends(get_current_user), request: Request = None
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    client: Client = Depends(get_supabase_client),
+    request: Request = None,
 ):
     """Logout current user"""
 
+    # End the Supabase session so its refresh token can't mint new tokens
     try:
-        client: Client = get_supabase_client()
+        await run_in_threadpool(
+            client.auth.admin.sign_out, current_user["token"], "local"
+        )
+    except AuthError as e:
+        logger.warning("Supabase sign out failed: %s", e)
 
-        # Sign out user
-        client.auth.sign_out()
+    # The access token itself stays valid until it expires, so refuse it here
+    await revoke_token(current_user)
 
-        return {"message": "Logged out successfully"}
-
-    except Exception as e:
-        logger.error(f"Logout error: {e}")
-        return {"message": "Logout completed"}
+    return {"message": "Logged out successfully"}
 
 
 @router.get("/me", response_model=UserProfile)
 async def get_current_user_profile(
-    current_user: Dict[str, Any] = Depends(get_current_user),
+    current_user: Dict[str, Any] = Depends(get_current_user_full),
 ):
     """Get current user profile"""
 
-    try:
-        client: Client = get_supabase_client()
-
-        # Get updated user data
-        user_response = client.auth.get_user()
-
-        if user_response.user is None:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
-            )
+    user = current_user["user"]
+    user_metadata = user.user_metadata or {}
 
-        user_metadata = user_response.user.user_metadata or {}
-
-        return UserProfile(
-            id=user_response.user.id,
-            email=user_response.user.email,
-            full_name=user_metadata.get("full_name"),
-            username=user_metadata.get("username"),
-            created_at=user_response.user.created_at,
-            email_verified=user_response.user.email_confirmed_at is not None,
-        )
-
-    except Exception as e:
-        logger.error(f"Get user profile error: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to get user profile",
-        )
+    return UserProfile.model_construct(
+        id=user.id,
+        email=user.email,
+        full_name=user_metadata.get("full_name"),
+        username=user_metadata.get("username"),
+        created_at=user.created_at,
+        email_verified=user.email_confirmed_at is not None,
+    )
 
 
 @router.put("/profile", response_model=UserProfile)
@@ -232,16 +244,17 @@ async def update_profile(
     profile_data: Dict[str, str],
     current_user: Dict[str, Any] = Depends(get_current_user),
     request: Request = None,
+    client: Client = Depends(get_supabase_client),
 ):
     """Update user profile"""
 
     # await rate_limiter.check_rate_limit(request)
 
     try:
-        client: Client = get_supabase_client()
-
         # Update user metadata
-        response = client.auth.update_user({"data": profile_data})
+        response = await run_in_threadpool(
+            _update_user, client, current_user["token"], {"data": profile_data}
+        )
 
         if response.user is None:
             raise HTTPException(
@@ -250,7 +263,7 @@ async def update_profile(
 
         user_metadata = response.user.user_metadata or {}
 
-        return UserProfile(
+        return UserProfile.model_construct(
             id=response.user.id,
             email=response.user.email,
             full_name=user_metadata.get("full_name"),
@@ -259,8 +272,8 @@ async def update_profile(
             email_verified=response.user.email_confirmed_at is not None,
         )
 
-    except Exception as e:
-        logger.error(f"Profile update error: {e}")
+    except AuthError as e:
+        logger.warning("Profile update failed: %s", e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Profile update failed"
         )
@@ -271,16 +284,20 @@ async def change_password(
     password_data: PasswordChange,
     current_user: Dict[str, Any] = Depends(get_current_user),
     request: Request = None,
+    client: Client = Depends(get_supabase_client),
 ):
     """Change user password"""
 
     # await rate_limiter.check_rate_limit(request)
 
     try:
-        client: Client = get_supabase_client()
-
         # Update password
-        response = client.auth.update_user({"password": password_data.new_password})
+        response = await run_in_threadpool(
+            _update_user,
+            client,
+            current_user["token"],
+            {"password": password_data.new_password},
+        )
 
         if response.user is None:
             raise HTTPException(
@@ -289,47 +306,51 @@ async def change_password(
 
         return {"message": "Password changed successfully"}
 
-    except Exception as e:
-        logger.error(f"Password change error: {e}")
+    except AuthError as e:
+        logger.warning("Password change failed: %s", e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Password change failed"
         )
 
 
 @router.post("/reset-password")
-async def reset_password(reset_data: PasswordReset, request: Request):
+async def reset_password(
+    reset_data: PasswordReset,
+    request: Request,
+    client: Client = Depends(get_supabase_client),
+):
     """Send password reset email"""
 
     # await rate_limiter.check_rate_limit(request)
 
     try:
-        client: Client = get_supabase_client()
-
         # Send reset password email
-        client.auth.reset_password_email(reset_data.email)
+        await run_in_threadpool(client.auth.reset_password_email, reset_data.email)
 
         return {"message": "Password reset email sent"}
 
     except Exception as e:
-        logger.error(f"Password reset error: {e}")
+        logger.error("Password reset error: %s", e)
         # Don't reveal if email exists or not
         return {"message": "Password reset email sent"}
 
 
 @router.post("/verify-email")
-async def verify_email(verification_data: EmailVerification):
+async def verify_email(
+    verification_data: EmailVerification,
+    client: Client = Depends(get_supabase_client),
+):
     """Verify email with token"""
 
     try:
-        client: Client = get_supabase_client()
-
         # Verify email
-        response = client.auth.verify_otp(
+        response = await run_in_threadpool(
+            client.auth.verify_otp,
             {
                 "email": verification_data.email,
                 "token": verification_data.token,
                 "type": "email",
-            }
+            },
         )
 
         if response.user is None:
@@ -340,8 +361,8 @@ async def verify_email(verification_data: EmailVerification):
 
         return {"message": "Email verified successfully"}
 
-    except Exception as e:
-        logger.error(f"Email verification error: {e}")
+    except AuthError as e:
+        logger.warning("Email verification failed: %s", e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Email verification failed"
         )
@@ -1,45 +1,150 @@
 from fastapi import Depends, HTTPException, status, Request
-from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from app.config import settings
+from fastapi.concurrency import run_in_threadpool
+from app.cache import TTLCache
+from app.config import Settings, get_settings, settings
 from app.db import get_supabase_client
+from app.rate_limiter import get_redis, user_rate_limiter
+from redis.exceptions import RedisError
 from supabase.client import Client
+import asyncio
 import jwt
+import hashlib
+import time
 from typing import Dict, Any, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Security scheme for bearer token
-security = HTTPBearer(auto_error=False)
+# Shared by every 401 response; Starlette copies headers, never mutates them
+_BEARER_HEADERS = {"WWW-Authenticate": "Bearer"}
+
+# Validated users keyed by token digest, kept until the token expires
+# (capped at JWT_CACHE_MAX_LIFETIME, like PostgREST's jwt-cache-max-lifetime)
+_token_cache = TTLCache(maxsize=settings.JWT_CACHE_MAX_SIZE)
+
+# Digests of logged-out tokens -> token exp. A plain dict rather than an
+# LRU so no revocation is evicted before the token would have expired;
+# with Redis configured the revocation is shared with every worker too
+_revoked_tokens: Dict[str, float] = {}
+_REVOKED_KEY_PREFIX = "revoked:"
+
+
+# Supabase signs access tokens with asymmetric keys published as a JWKS
+_ASYMMETRIC_ALGORITHMS = ["RS256", "ES256"]
+_JWKS_MIN_REFRESH_INTERVAL = 60  # seconds between JWKS fetch attempts
+
+_jwks_client = jwt.PyJWKClient(
+    f"{settings.SUPABASE_URL}/auth/v1/.well-known/jwks.json", cache_jwk_set=False
+)
+
+# Parsed public keys by kid, so verification never re-parses the JWKS JSON
+_jwks_keys: Dict[str, Any] = {}
+_jwks_fetched_at = 0.0
+# Last fetch attempt, successful or not; failures back off from here
+_jwks_attempted_at = 0.0
+# One request refetches while the others wait for its keys
+_jwks_lock = asyncio.Lock()
+
+
+def _bearer_token(request: Request) -> Optional[str]:
+    """Extract the token from an 'Authorization: Bearer <token>' header"""
+    auth = request.headers.get("authorization")
+    return auth[7:] if auth and auth[:7].lower() == "bearer " else None
+
+
+def _token_cache_key(token: str) -> str:
+    """Hash the raw token so the cache never holds bearer credentials"""
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+def _fetch_jwks() -> Dict[str, Any]:
+    """Fetch the project's JWKS and parse each key into a public key object"""
+    jwk_set = _jwks_client.get_jwk_set()
+    return {key.key_id: key.key for key in jwk_set.keys if key.key_id}
+
+
+def _jwks_refresh_due(kid: Optional[str], settings: Settings) -> bool:
+    """Whether the JWKS should be refetched before looking up kid"""
+    now = time.time()
+
+    # Refresh on expiry, or early on an unknown kid in case keys were rotated,
+    # but never more than once per interval however the last attempt went
+    return now - _jwks_attempted_at > _JWKS_MIN_REFRESH_INTERVAL and (
+        now - _jwks_fetched_at > settings.JWKS_CACHE_LIFETIME or kid not in _jwks_keys
+    )
+
+
+async def _get_signing_key(kid: Optional[str], settings: Settings) -> Any:
+    """Return the cached public key for kid, refetching the JWKS when needed"""
+    global _jwks_keys, _jwks_fetched_at, _jwks_attempted_at
+
+    if _jwks_refresh_due(kid, settings):
+        async with _jwks_lock:
+            # Another request may have refreshed while this one waited
+            if _jwks_refresh_due(kid, settings):
+                _jwks_attempted_at = time.time()
+                try:
+                    _jwks_keys = await run_in_threadpool(_fetch_jwks)
+                    _jwks_fetched_at = time.time()
+                except Exception as e:
+                    # Keep verifying with the keys we have until the retry
+                    logger.warning("JWKS refresh failed: %s", e)
+
+    key = _jwks_keys.get(kid)
+    if key is None:
+        raise jwt.InvalidTokenError("Unknown signing key")
+
+    return key
+
+
+async def _decode_token(token: str, settings: Settings) -> Dict[str, Any]:
+    """Verify the token signature and claims, returning the payload"""
+    header = jwt.get_unverified_header(token)
+
+    if header.get("alg") == "HS256" and settings.SUPABASE_JWT_SECRET:
+        # Legacy projects still sign with the shared JWT secret
+        key, algorithms = settings.SUPABASE_JWT_SECRET, ["HS256"]
+    else:
+        key = await _get_signing_key(header.get("kid"), settings)
+        algorithms = _ASYMMETRIC_ALGORITHMS
+
+    return jwt.decode(token, key, algorithms=algorithms, audience="authenticated")
 
 
 async def get_current_user(
     request: Request,
-    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
+    token: Optional[str] = Depends(_bearer_token),
+    settings: Settings = Depends(get_settings),
 ) -> Dict[str, Any]:
     """
     Dependency to get current authenticated user from JWT token.
     This validates the Supabase JWT token and returns user information.
     """
 
-    if credentials is None:
+    if not token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Authentication credentials required",
-            headers={"WWW-Authenticate": "Bearer"},
+            headers=_BEARER_HEADERS,
         )
 
-    token = credentials.credentials
+    cache_key = _token_cache_key(token)
 
-    try:
-        # Validate JWT token using Supabase JWT secret
-        payload = jwt.decode(
-            token,
-            settings.SUPABASE_JWT_SECRET,
-            algorithms=["HS256"],
-            audience="authenticated",
+    if await _is_revoked(cache_key):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token has been revoked",
+            headers=_BEARER_HEADERS,
         )
 
+    cached_user = _token_cache.get(cache_key)
+    if cached_user is not None:
+        return {**cached_user, "token": token}
+
+    try:
+        # Validate JWT token against the project's signing keys
+        payload = await _decode_token(token, settings)
+
         # Extract user information from JWT payload
         user_id = payload.get("sub")
         email = payload.get("email")
@@ -49,54 +154,113 @@ async def get_current_user(
                 status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token payload"
             )
 
-        # Optional: Validate token with Supabase (for extra security)
-        # This makes a request to Supabase to verify the token is still valid
-        client: Client = get_supabase_client()
+        # The signature proves authenticity, so no Supabase round-trip here;
+        # endpoints that need the full user record use get_current_user_full
 
-        try:
-            # Set the JWT token for the client
-            client.postgrest.auth(token)
-            user_response = client.auth.get_user(token)
-
-            if user_response.user is None:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="User not found or token invalid",
-                )
-
-            # Return user information
-            return {
-                "id": user_id,
-                "email": email,
-                "user": user_response.user,
-                "token": token,
-            }
-
-        except Exception as supabase_error:
-            # If Supabase validation fails, still trust JWT if it's valid
-            logger.warning(f"Supabase token validation failed: {supabase_error}")
-
-            return {"id": user_id, "email": email, "token": token}
+        # The cache keeps the decoded identity only; the token is added back
+        # per request so no bearer credential is held in memory
+        current_user = {
+            "id": user_id,
+            "email": email,
+            "claims": payload,
+        }
+
+        expires_at = min(
+            payload.get("exp", 0), time.time() + settings.JWT_CACHE_MAX_LIFETIME
+        )
+        _token_cache.set(cache_key, current_user, expires_at)
+
+        # Return user information
+        return {**current_user, "token": token}
 
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token has expired",
-            headers={"WWW-Authenticate": "Bearer"},
+            headers=_BEARER_HEADERS,
         )
     except jwt.PyJWTError as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"Invalid token: {str(e)}",
-            headers={"WWW-Authenticate": "Bearer"},
+            headers=_BEARER_HEADERS,
         )
     except Exception as e:
-        logger.error(f"Authentication error: {e}")
+        logger.error("Authentication error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Authentication failed",
-            headers={"WWW-Authenticate": "Bearer"},
+            headers=_BEARER_HEADERS,
+        )
+
+
+async def _is_revoked(cache_key: str) -> bool:
+    """Whether the token with this digest was logged out on any worker"""
+    expires_at = _revoked_tokens.get(cache_key)
+    if expires_at is not None and expires_at > time.time():
+        return True
+
+    redis = get_redis()
+    if redis is None:
+        return False
+
+    try:
+        return bool(await redis.exists(_REVOKED_KEY_PREFIX + cache_key))
+    except RedisError as e:
+        logger.warning("Redis revocation check failed, using in-memory: %s", e)
+        return False
+
+
+async def revoke_token(current_user: Dict[str, Any]):
+    """Reject the current user's token from now until it expires"""
+    cache_key = _token_cache_key(current_user["token"])
+    expires_at = int(current_user["claims"].get("exp", 0))
+    now = time.time()
+
+    _token_cache.pop(cache_key)
+
+    # Entries are only needed until their token expires
+    for key in [key for key, exp in _revoked_tokens.items() if exp <= now]:
+        del _revoked_tokens[key]
+
+    if expires_at <= now:
+        return
+
+    _revoked_tokens[cache_key] = expires_at
+
+    redis = get_redis()
+    if redis is not None:
+        try:
+            await redis.set(_REVOKED_KEY_PREFIX + cache_key, 1, exat=expires_at)
+        except RedisError as e:
+            logger.warning("Could not share token revocation via Redis: %s", e)
+
+
+async def get_current_user_full(
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    client: Client = Depends(get_supabase_client),
+) -> Dict[str, Any]:
+    """
+    Dependency that also fetches the full Supabase user record.
+    This makes a request to Supabase, so only use it where the record is needed.
+    """
+
+    try:
+        user_response = await run_in_threadpool(
+            client.auth.get_user, current_user["token"]
         )
+    except Exception as e:
+        logger.warning("Supabase user lookup failed: %s", e)
+        user_response = None
+
+    if user_response is None or user_response.user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found or token invalid",
+            headers=_BEARER_HEADERS,
+        )
+
+    return {**current_user, "user": user_response.user}
 
 
 async def get_current_active_user(
@@ -114,14 +278,14 @@ async def get_current_active_user(
 
 # Optional: Admin user dependency
 async def get_admin_user(
-    current_user: Dict[str, Any] = Depends(get_current_user),
+    current_user: Dict[str, Any] = Depends(get_current_user_full),
 ) -> Dict[str, Any]:
     """
     Dependency to ensure current user is an admin
     """
 
     # Check if user has admin role
-    user_metadata = current_user.get("user", {}).user_metadata or {}
+    user_metadata = current_user["user"].user_metadata or {}
     user_role = user_metadata.get("role", "user")
 
     if user_role != "admin":
@@ -140,10 +304,8 @@ async def get_current_user_with_rate_limit(
     Dependency that combines user authentication with rate limiting
     """
 
-    # from app.rate_limiter import rate_limiter
-
     # Use user ID for rate limiting instead of IP
     user_id = current_user.get("id")
-    # await rate_limiter.check_rate_limit(request, identifier=user_id)
+    await user_rate_limiter.check_rate_limit(user_id)
 
     return current_user
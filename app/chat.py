@@ -1,14 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from app.models import AuthenticatedChatRequest, ConversationHistory
 from app.stream import StreamingService
-from app.db import get_conversation_history, get_session_threads, delete_thread
+from app.db import (
+    get_conversation_history,
+    iter_conversation_history,
+    get_session_threads,
+    delete_thread,
+    normalize_thread_id,
+)
 from app.auth_dependencies import get_current_user, get_current_user_with_rate_limit
-from typing import Dict, Any
+from datetime import datetime
+from typing import AsyncIterator, Dict, Any, Optional
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+# Largest page /history will fetch in one request
+_MAX_HISTORY_PAGE = 200
+
+
+def scoped_thread_id(thread_id: str) -> str:
+    """Path dependency resolving the thread id to its stored form"""
+    return normalize_thread_id(thread_id)
+
 
 @router.post("/stream")
 async def stream_chat(
@@ -26,52 +43,96 @@ async def stream_chat(
     user_id = current_user.get("id")
 
     # Ensure user owns the session
-    if not request.session_id.startswith(user_id):
-        request.session_id = f"{user_id}_{request.session_id}"
+    if not request.session_id.startswith(f"{user_id}_"):
+        request = request.model_copy(
+            update={"session_id": f"{user_id}_{request.session_id}"}
+        )
 
     # # Ensure user owns the thread
     # if not request.thread_id.startswith(user_id):
     #     request.thread_id = f"{user_id}_{request.thread_id}"
 
-    logger.info(f"User {user_id} starting chat in thread {request.thread_id}")
+    logger.info("User %s starting chat in thread %s", user_id, request.thread_id)
 
     # Create streaming response
     return StreamingService.create_streaming_response(request, user_id)
 
 
+async def _ndjson_history(
+    thread_id: str,
+    user_id: str,
+    limit: int,
+    before: Optional[datetime],
+    before_id: Optional[str],
+) -> AsyncIterator[bytes]:
+    """Encode each history message as one NDJSON line"""
+    async for msg in iter_conversation_history(
+        thread_id, user_id, limit, before, before_id
+    ):
+        yield orjson.dumps(
+            {
+                "id": msg.id,
+                "role": msg.role.value,
+                "content": msg.content,
+                "timestamp": msg.timestamp,
+            }
+        ) + b"\n"
+
+
 @router.get("/history/{thread_id}")
 async def get_chat_history(
-    thread_id: str,
+    http_request: Request,
+    thread_id: str = Depends(scoped_thread_id),
     current_user: Dict[str, Any] = Depends(get_current_user),
-    limit: int = 50,
+    limit: int = Query(50, ge=1, le=_MAX_HISTORY_PAGE),
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
 ):
     """Get conversation history for a thread - PROTECTED ROUTE"""
 
     user_id = current_user.get("id")
 
-    # Ensure user owns the thread
-    if not thread_id.startswith("req"):
-        thread_id = f"req_{thread_id}"
+    # NDJSON clients get one message per line instead of a buffered document
+    if "application/x-ndjson" in http_request.headers.get("accept", ""):
+        return StreamingResponse(
+            _ndjson_history(thread_id, user_id, limit, before, before_id),
+            media_type="application/x-ndjson",
+        )
 
     try:
-        messages = await get_conversation_history(thread_id, limit)
-
-        return {
-            "thread_id": thread_id,
-            "user_id": user_id,
-            "messages": [
-                {
-                    "role": msg.role.value,
-                    "content": msg.content,
-                    "timestamp": msg.timestamp.isoformat(),
-                }
-                for msg in messages
-            ],
-            "message_count": len(messages),
-        }
+        messages = await get_conversation_history(
+            thread_id, user_id, limit, before=before, before_id=before_id
+        )
+
+        # orjson encodes the datetimes itself, no per-row isoformat()
+        return ORJSONResponse(
+            {
+                "thread_id": thread_id,
+                "user_id": user_id,
+                "messages": [
+                    {
+                        "id": msg.id,
+                        "role": msg.role.value,
+                        "content": msg.content,
+                        "timestamp": msg.timestamp,
+                    }
+                    for msg in messages
+                ],
+                "message_count": len(messages),
+                # Pass back as ?before=&before_id= to fetch the previous page
+                "next_before": (
+                    messages[0].timestamp
+                    if messages and len(messages) == limit
+                    else None
+                ),
+                "next_before_id": (
+                    messages[0].id if messages and len(messages) == limit else None
+                ),
+            }
+        )
 
     except Exception as e:
-        logger.error(f"Error getting chat history for user {user_id}: {e}")
+        logger.error("Error getting chat history for user %s: %s", user_id, e)
         raise HTTPException(status_code=500, detail="Failed to retrieve chat history")
 
 
@@ -83,41 +144,35 @@ async def get_user_threads(current_user: Dict[str, Any] = Depends(get_current_us
     session_id_prefix = f"{user_id}_"
 
     try:
-        # Get threads that belong to this user
-        all_threads = await get_session_threads(user_id)
-
-        # Filter threads that belong to the user
-        user_threads = [
-            thread for thread in all_threads if thread.get("session_id", "")
-        ]
-
-        return {
-            "user_id": user_id,
-            "threads": user_threads,
-            "thread_count": len(user_threads),
-        }
+        # Get threads that belong to this user's sessions
+        user_threads, thread_count = await get_session_threads(
+            user_id, session_id_prefix
+        )
+
+        return ORJSONResponse(
+            {
+                "user_id": user_id,
+                "threads": user_threads,
+                "thread_count": thread_count,
+            }
+        )
 
     except Exception as e:
-        logger.error(f"Error getting threads for user {user_id}: {e}")
+        logger.error("Error getting threads for user %s: %s", user_id, e)
         raise HTTPException(status_code=500, detail="Failed to retrieve threads")
 
 
 @router.delete("/threads/{thread_id}")
 async def delete_thread_endpoint(
-    thread_id: str,
+    thread_id: str = Depends(scoped_thread_id),
     current_user: Dict[str, Any] = Depends(get_current_user_with_rate_limit),
 ):
     """Delete a thread and all its messages - PROTECTED ROUTE"""
 
     user_id = current_user.get("id")
-    # session_id = f"{user_id}_default"  # or derive from thread
-
-    # Ensure user owns the thread
-    if not thread_id.startswith("req"):
-        thread_id = f"req_{thread_id}"
 
     try:
-        success = await delete_thread(thread_id, session_id)
+        success = await delete_thread(thread_id, user_id)
 
         if not success:
             raise HTTPException(status_code=500, detail="Failed to delete thread")
@@ -125,7 +180,7 @@ async def delete_thread_endpoint(
         return {"message": f"Thread {thread_id} deleted successfully"}
 
     except Exception as e:
-        logger.error(f"Error deleting thread {thread_id} for user {user_id}: {e}")
+        logger.error("Error deleting thread %s for user %s: %s", thread_id, user_id, e)
         raise HTTPException(status_code=500, detail="Failed to delete thread")
 
 
@@ -133,16 +188,18 @@ async def delete_thread_endpoint(
 async def get_chat_status(current_user: Dict[str, Any] = Depends(get_current_user)):
     """Get chat service status for authenticated user"""
 
-    return {
-        "service": "chat",
-        "status": "healthy",
-        "user_id": current_user.get("id"),
-        "user_email": current_user.get("email"),
-        "features": {
-            "streaming": True,
-            "rate_limiting": True,
-            "conversation_memory": True,
-            "artifact_detection": True,
-            "user_isolation": True,
-        },
-    }
+    return ORJSONResponse(
+        {
+            "service": "chat",
+            "status": "healthy",
+            "user_id": current_user.get("id"),
+            "user_email": current_user.get("email"),
+            "features": {
+                "streaming": True,
+                "rate_limiting": True,
+                "conversation_memory": True,
+                "artifact_detection": True,
+                "user_isolation": True,
+            },
+        }
+    )
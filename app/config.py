@@ -1,34 +1,57 @@
-from pydantic_settings import BaseSettings
-from typing import Optional
-import os
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from functools import lru_cache
+from typing import List
 
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=True)
+
     # Database settings
-    SUPABASE_URL: str = os.getenv("SUPABASE_URL", "")
-    SUPABASE_KEY: str = os.getenv("SUPABASE_KEY", "")
-    SUPABASE_JWT_SECRET: str = os.getenv("SUPABASE_JWT_SECRET", "")  # NEW
+    SUPABASE_URL: str = ""
+    SUPABASE_KEY: str = ""
+    SUPABASE_JWT_SECRET: str = ""  # legacy HS256
+    JWKS_CACHE_LIFETIME: int = 900  # seconds
+    DATABASE_URL: str = ""  # Postgres DSN (use the pooler URL on Supabase)
+    DB_POOL_MIN_SIZE: int = 10
+    DB_POOL_MAX_SIZE: int = 50
 
     # Gemini API settings
-    GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
+    GEMINI_API_KEY: str = ""
     GEMINI_MODEL: str = "gemini-2.0-flash-exp"
+    GEMINI_SESSION_CACHE_SIZE: int = 512  # reusable chat sessions
+    GEMINI_SESSION_CACHE_TTL: int = 600  # seconds
 
     # Rate limiting settings
     RATE_LIMIT_REQUESTS: int = 10
     RATE_LIMIT_WINDOW: int = 60  # seconds
+    REDIS_URL: str = ""  # shared limits across workers; in-memory if unset
 
-    # Authentication settings  # NEW
+    # Authentication settings
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
     REFRESH_TOKEN_EXPIRE_DAYS: int = 7
+    JWT_CACHE_MAX_LIFETIME: int = 600  # seconds
+    JWT_CACHE_MAX_SIZE: int = 10000
 
     # Application settings
     MAX_CONVERSATION_LENGTH: int = 50
+    HISTORY_TOKEN_BUDGET: int = 6000  # approximate prompt tokens of history
+    HISTORY_CACHE_MAX_SIZE: int = 1024  # threads
+    HISTORY_CACHE_TTL: int = 600  # seconds
     MAX_TOKENS: int = 8192
     TEMPERATURE: float = 0.7
+    LOG_LEVEL: str = "INFO"  # use WARNING in production
+    CORS_ORIGINS: List[str] = [
+        "http://localhost:3000",
+        "http://localhost:5173",
+        "http://127.0.0.1:3000",
+        "http://127.0.0.1:5173",
+    ]
+
 
-    class Config:
-        env_file = ".env"
-        case_sensitive = True
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Load settings from the environment once per process"""
+    return Settings()
 
 
-settings = Settings()
+settings = get_settings()
@@ -1,222 +1,502 @@
 from supabase import create_client, Client
+from app.cache import TTLCache
 from app.config import settings
 from app.models import ChatMessage, MessageRole, ConversationHistory
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Tuple
 import logging
 import asyncio
-from datetime import datetime
+import asyncpg
+import time
+import weakref
+from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger(__name__)
 
-# Global Supabase client
+# Global Supabase client (authentication)
 supabase: Optional[Client] = None
 
+# Global Postgres connection pool (chat data)
+pool: Optional[asyncpg.Pool] = None
+
+# Thread ids are stored with this prefix
+THREAD_ID_PREFIX = "req_"
+
+# Recent prompt history per thread, appended to by save_message so repeat
+# turns skip the read. Values are (user_id, messages, complete, version);
+# messages are the newest rows in order, complete means they are the whole
+# thread, and version is the threads.message_count they correspond to.
+_history_cache = TTLCache(maxsize=settings.HISTORY_CACHE_MAX_SIZE)
+_history_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+def normalize_thread_id(thread_id: str) -> str:
+    """Return the stored form of a client-supplied thread id"""
+    return thread_id if thread_id.startswith("req") else THREAD_ID_PREFIX + thread_id
+
 
 async def init_database():
-    """Initialize Supabase client"""
-    global supabase
+    """Initialize the process-wide Supabase client and Postgres pool"""
+    global supabase, pool
+
+    if supabase is not None:
+        return
 
     if not settings.SUPABASE_URL or not settings.SUPABASE_KEY:
         raise ValueError("Supabase URL and Key must be provided")
 
+    if not settings.DATABASE_URL:
+        raise ValueError("Database URL must be provided")
+
     supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
     logger.info("Supabase client initialized")
 
+    # statement_cache_size=0 is required behind Supabase's pgbouncer
+    # transaction pooler, which cannot keep prepared statements
+    pool = await asyncpg.create_pool(
+        settings.DATABASE_URL,
+        min_size=settings.DB_POOL_MIN_SIZE,
+        max_size=settings.DB_POOL_MAX_SIZE,
+        max_queries=50000,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=0,
+    )
+    logger.info("Database pool initialized")
+
+
+async def close_database():
+    """Close the Postgres pool and the Supabase client's HTTP connections"""
+    global supabase, pool
+
+    if pool is not None:
+        await pool.close()
+        pool = None
+        logger.info("Database pool closed")
+
+    if supabase is None:
+        return
+
+    try:
+        supabase.postgrest.aclose()
+        supabase.auth.close()
+    except Exception as e:
+        logger.error("Error closing Supabase client: %s", e)
+    finally:
+        supabase = None
+        logger.info("Supabase client closed")
+
 
 def get_supabase_client() -> Client:
-    """Get the initialized Supabase client"""
+    """Get the initialized Supabase client (usable as a FastAPI dependency)"""
     if supabase is None:
         raise RuntimeError("Supabase client not initialized")
     return supabase
 
 
+def get_pool() -> asyncpg.Pool:
+    """Get the initialized Postgres connection pool"""
+    if pool is None:
+        raise RuntimeError("Database pool not initialized")
+    return pool
+
+
+def _history_lock(key: str) -> asyncio.Lock:
+    """Per-thread lock ordering history reads against saves"""
+    lock = _history_locks.get(key)
+    if lock is None:
+        lock = _history_locks[key] = asyncio.Lock()
+    return lock
+
+
 async def save_message(
     thread_id: str, session_id: str, role: MessageRole, content: str, user_id: str
 ) -> bool:
-    """Save a message to the database"""
-    try:
-        client = get_supabase_client()
+    """Save a message and bump its thread's metadata in one round-trip.
 
-        data = {
-            "thread_id": thread_id,
-            "session_id": session_id,
-            "user_id": user_id,
-            "role": role.value,
-            "content": content,
-            "created_at": datetime.utcnow().isoformat(),
-        }
+    Returns False, saving nothing, if the thread belongs to another user.
+    """
+    created_at = datetime.now(timezone.utc)
+
+    try:
+        async with _history_lock(thread_id):
+            # The thread upsert runs first and only updates a row the caller
+            # owns; the message is inserted only if the upsert went through.
+            # The count is kept incrementally instead of re-running count(*).
+            saved = await get_pool().fetchval(
+                """
+                WITH thread AS (
+                    INSERT INTO threads
+                        (thread_id, user_id, session_id, message_count, last_activity)
+                    VALUES ($1, $3, $2, 1, $6)
+                    ON CONFLICT (thread_id) DO UPDATE SET
+                        session_id = EXCLUDED.session_id,
+                        message_count = threads.message_count + 1,
+                        last_activity = EXCLUDED.last_activity
+                    WHERE threads.user_id = EXCLUDED.user_id
+                    RETURNING 1
+                )
+                INSERT INTO messages
+                    (thread_id, session_id, user_id, role, content, created_at)
+                SELECT $1, $2, $3, $4, $5, $6 FROM thread
+                RETURNING 1
+                """,
+                thread_id,
+                session_id,
+                user_id,
+                role.value,
+                content,
+                created_at,
+            )
 
-        result = client.table("messages").insert(data).execute()
+            if saved is None:
+                logger.warning(
+                    "User %s tried to write to thread %s owned by another user",
+                    user_id,
+                    thread_id,
+                )
+                return False
 
-        # Update thread metadata
-        await update_thread_metadata(thread_id, session_id, user_id)
+            cached = _history_cache.get(thread_id)
+            if cached is not None and cached[0] == user_id:
+                _, messages, complete, version = cached
+                messages.append(
+                    ChatMessage(role=role, content=content, timestamp=created_at)
+                )
+                if len(messages) > settings.MAX_CONVERSATION_LENGTH:
+                    messages = messages[-settings.MAX_CONVERSATION_LENGTH :]
+                    complete = False
+
+                # Only this save is accounted for; if another worker wrote
+                # too, the stored count moves further and the entry is re-read
+                _history_cache.set(
+                    thread_id,
+                    (user_id, messages, complete, version + 1),
+                    time.time() + settings.HISTORY_CACHE_TTL,
+                )
 
         return True
 
     except Exception as e:
-        logger.error(f"Error saving message: {e}")
+        logger.error("Error saving message: %s", e)
         return False
 
 
 async def update_thread_metadata(thread_id: str, session_id: str, user_id: str):
-    """Update thread metadata (last activity, message count)"""
+    """Recount a thread's messages and update its metadata, if user_id owns it"""
     try:
-        client = get_supabase_client()
-
-        # Get message count
-        count_result = (
-            client.table("messages")
-            .select("*", count="exact")
-            .eq("thread_id", thread_id)
-            .execute()
+        await get_pool().execute(
+            """
+            INSERT INTO threads
+                (thread_id, user_id, session_id, message_count, last_activity)
+            VALUES (
+                $1, $2, $3,
+                (SELECT count(*) FROM messages WHERE thread_id = $1),
+                $4
+            )
+            ON CONFLICT (thread_id) DO UPDATE SET
+                session_id = EXCLUDED.session_id,
+                message_count = EXCLUDED.message_count,
+                last_activity = EXCLUDED.last_activity
+            WHERE threads.user_id = EXCLUDED.user_id
+            """,
+            thread_id,
+            user_id,
+            session_id,
+            datetime.now(timezone.utc),
         )
 
-        message_count = count_result.count or 0
+    except Exception as e:
+        logger.error("Error updating thread metadata: %s", e)
 
-        # Upsert thread metadata
-        thread_data = {
-            "thread_id": thread_id,
-            "user_id": user_id,
-            "session_id": session_id,
-            "message_count": message_count,
-            "last_activity": datetime.utcnow().isoformat(),
-        }
 
-        client.table("threads").upsert(thread_data).execute()
+def _within_token_budget(
+    messages: List[ChatMessage], token_budget: int
+) -> List[ChatMessage]:
+    """Keep the newest messages whose approximate token count fits the budget"""
+    tokens = 0
+    start = len(messages)
+    while start > 0:
+        # ~4 characters per token is close enough for prompt sizing
+        tokens += len(messages[start - 1].content) // 4
+        if tokens > token_budget:
+            break
+        start -= 1
 
-    except Exception as e:
-        logger.error(f"Error updating thread metadata: {e}")
+    return messages[start:]
 
 
 async def get_conversation_history(
-    thread_id: str, limit: int = 50
+    thread_id: str,
+    user_id: str,
+    limit: int = 50,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
 ) -> List[ChatMessage]:
-    """Get conversation history for a thread"""
+    """Get the newest messages of a thread owned by user_id, oldest first.
+
+    Passing ``before``/``before_id`` (the timestamp and id of the oldest
+    message on the previous page) pages back through older messages using
+    the (thread_id, created_at) index.
+    """
+    query, args = _history_query(thread_id, user_id, limit, before, before_id)
+
     try:
-        client = get_supabase_client()
-
-        result = (
-            client.table("messages")
-            .select("*")
-            .eq("thread_id", thread_id)
-            .order("created_at", desc=False)
-            .limit(limit)
-            .execute()
-        )
-        thread_id_assistant = thread_id.replace("req_", "")
-        assitant_result = (
-            client.table("messages")
-            .select("*")
-            .eq("thread_id", thread_id_assistant)
-            .order("created_at", desc=False)
-            .limit(limit)
-            .execute()
-        )
+        rows = await get_pool().fetch(query, *args)
+
+        return [
+            ChatMessage(
+                role=MessageRole(row["role"]),
+                content=row["content"],
+                timestamp=row["created_at"],
+                id=row["id"],
+            )
+            for row in rows
+        ]
 
-        messages = []
-        for row in result.data:
-            messages.append(
-                ChatMessage(
-                    role=MessageRole(row["role"]),
-                    content=row["content"],
-                    timestamp=datetime.fromisoformat(
-                        row["created_at"].replace("Z", "+00:00")
-                    ),
-                )
+    except Exception as e:
+        logger.error("Error getting conversation history: %s", e)
+        return []
+
+
+async def get_prompt_history(
+    thread_id: str, user_id: str, limit: int, token_budget: int
+) -> Tuple[List[ChatMessage], Optional[int]]:
+    """Get the newest messages of a thread for the model prompt.
+
+    Returns the messages with the thread's message_count they were read at.
+    Served from the history cache while that count still matches; a write
+    from another worker or a deleted thread changes the count and forces a
+    re-read.
+    """
+    try:
+        async with _history_lock(thread_id):
+            db = get_pool()
+
+            cached = _history_cache.get(thread_id)
+            if cached is not None and cached[0] == user_id:
+                _, messages, complete, version = cached
+                if complete or limit <= len(messages):
+                    current = await db.fetchval(
+                        "SELECT message_count FROM threads WHERE thread_id = $1",
+                        thread_id,
+                    )
+                    if (current or 0) == version:
+                        messages = messages[max(len(messages) - limit, 0) :]
+                        return _within_token_budget(messages, token_budget), version
+
+            # The count comes from the same snapshot as the rows
+            rows = await db.fetch(
+                """
+                SELECT role, content, created_at,
+                       (SELECT message_count FROM threads WHERE thread_id = $1)
+                           AS version
+                FROM messages
+                WHERE thread_id = $1 AND user_id = $2
+                ORDER BY created_at DESC
+                LIMIT $3
+                """,
+                thread_id,
+                user_id,
+                limit,
             )
-        for row in assitant_result.data:
-            messages.append(
+            if rows:
+                version = rows[0]["version"] or 0
+            else:
+                version = await db.fetchval(
+                    "SELECT message_count FROM threads WHERE thread_id = $1",
+                    thread_id,
+                )
+
+            messages = [
                 ChatMessage(
                     role=MessageRole(row["role"]),
                     content=row["content"],
-                    timestamp=datetime.fromisoformat(
-                        row["created_at"].replace("Z", "+00:00")
-                    ),
+                    timestamp=row["created_at"],
                 )
+                for row in reversed(rows)
+            ]
+            version = version or 0
+            _history_cache.set(
+                thread_id,
+                (user_id, messages, len(messages) < limit, version),
+                time.time() + settings.HISTORY_CACHE_TTL,
             )
 
-        messages.sort(key=lambda msg: msg.timestamp)
-        return messages
+            return _within_token_budget(messages, token_budget), version
 
     except Exception as e:
-        logger.error(f"Error getting conversation history: {e}")
-        return []
-
+        logger.error("Error getting prompt history: %s", e)
+        return [], None
+
+
+def _history_query(
+    thread_id: str,
+    user_id: str,
+    limit: int,
+    before: Optional[datetime],
+    before_id: Optional[str] = None,
+) -> Tuple[str, list]:
+    """SQL and args selecting a thread's newest messages, oldest first.
+
+    Rows are ordered by (created_at, id) so messages saved in the same
+    microsecond still page deterministically: the cursor is the oldest
+    row's pair, and a bare ``before`` falls back to the timestamp alone.
+    """
+    query = """
+        SELECT id::text AS id, role, content, created_at
+        FROM messages
+        WHERE thread_id = $1 AND user_id = $2
+    """
+    args = [thread_id, user_id, limit]
+
+    if before is not None and before_id is not None:
+        query += " AND (created_at, id::text) < ($4, $5)"
+        args.extend((before, before_id))
+    elif before is not None:
+        query += " AND created_at < $4"
+        args.append(before)
+
+    # Newest `limit` rows off the index, then back into reading order
+    query = f"""
+        SELECT * FROM (
+            {query} ORDER BY created_at DESC, id DESC LIMIT $3
+        ) recent
+        ORDER BY created_at ASC, id ASC
+    """
+    return query, args
+
+
+async def iter_conversation_history(
+    thread_id: str,
+    user_id: str,
+    limit: int = 50,
+    before: Optional[datetime] = None,
+    before_id: Optional[str] = None,
+) -> AsyncIterator[ChatMessage]:
+    """Yield conversation history for a thread as rows arrive from Postgres"""
+    query, args = _history_query(thread_id, user_id, limit, before, before_id)
 
-async def get_session_threads(user_id: str) -> List[dict]:
-    """Get all threads for a session"""
     try:
-        client = get_supabase_client()
-        result = (
-            client.table("threads")
-            .select("*")
-            .eq("user_id", user_id)
-            .order("last_activity", desc=True)
-            .execute()
-        )
-        print(result.data)
-        result_messages = (
-            client.table("messages").select("*").eq("user_id", user_id).execute()
-        )
-        print("samp")
-
-        updated_thread = []
-        for thread in result.data:
-            for message in result_messages.data:
-                if thread["thread_id"] == message["thread_id"]:
-                    # thread["message_count"] = message["message_count"]
-                    # max content 50words in title
-                    thread["title"] = " ".join(message["content"].split()[:10])
-                    if message["role"] == "user":
-                        updated_thread.append(thread)
-
-                    break
-        print(result_messages.data)
-        return updated_thread
+        # Server-side cursors only live inside a transaction, which also pins
+        # one pgbouncer backend for the cursor's prepared statement
+        async with get_pool().acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(query, *args):
+                    yield ChatMessage(
+                        role=MessageRole(row["role"]),
+                        content=row["content"],
+                        timestamp=row["created_at"],
+                        id=row["id"],
+                    )
 
     except Exception as e:
-        logger.error(f"Error getting session threads: {e}")
-        return []
+        logger.error("Error streaming conversation history: %s", e)
+
 
+def _escape_like(value: str) -> str:
+    """Escape LIKE wildcards so value matches literally"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
-async def delete_thread(thread_id: str, session_id: str) -> bool:
-    """Delete a thread and all its messages"""
+
+async def get_session_threads(
+    user_id: str, prefix: Optional[str] = None
+) -> Tuple[List[dict], int]:
+    """Get a user's threads and their total count, optionally by session_id prefix"""
     try:
-        client = get_supabase_client()
+        # Each thread comes back with its opening message; threads that don't
+        # open with a user message have no title and are left out
+        query = """
+            SELECT t.thread_id, t.user_id::text AS user_id, t.session_id,
+                   t.message_count, t.last_activity, first.content AS first_msg,
+                   count(*) OVER () AS thread_count
+            FROM threads t
+            CROSS JOIN LATERAL (
+                SELECT m.role, m.content
+                FROM messages m
+                WHERE m.thread_id = t.thread_id AND m.user_id = t.user_id
+                ORDER BY m.created_at ASC
+                LIMIT 1
+            ) first
+            WHERE t.user_id = $1 AND first.role = 'user'
+        """
+        args = [user_id]
+
+        if prefix:
+            query += " AND t.session_id LIKE $2"
+            args.append(f"{_escape_like(prefix)}%")
+
+        rows = await get_pool().fetch(query + " ORDER BY t.last_activity DESC", *args)
+
+        # The window count is computed by Postgres over the filtered rows,
+        # so it stays right if the listing is ever paged with LIMIT
+        thread_count = rows[0]["thread_count"] if rows else 0
+
+        threads = []
+        for row in rows:
+            thread = dict(row)
+            del thread["thread_count"]
+            # max 10 words in title
+            thread["title"] = " ".join(thread.pop("first_msg").split(None, 10)[:10])
+            threads.append(thread)
+
+        # Sizes only; the rows themselves can be large
+        logger.debug("Loaded %d threads for user %s", thread_count, user_id)
+        return threads, thread_count
+
+    except Exception as e:
+        logger.error("Error getting session threads: %s", e)
+        return [], 0
+
 
-        # Delete messages
-        client.table("messages").delete().eq("thread_id", thread_id).execute()
+async def delete_thread(thread_id: str, user_id: str) -> bool:
+    """Delete a thread owned by user_id and all its messages"""
+    try:
+        async with get_pool().acquire() as conn:
+            async with conn.transaction():
+                # Delete messages
+                await conn.execute(
+                    "DELETE FROM messages WHERE thread_id = $1 AND user_id = $2",
+                    thread_id,
+                    user_id,
+                )
 
-        # Delete thread metadata
-        client.table("threads").delete().eq("thread_id", thread_id).execute()
+                # Delete thread metadata
+                await conn.execute(
+                    "DELETE FROM threads WHERE thread_id = $1 AND user_id = $2",
+                    thread_id,
+                    user_id,
+                )
 
+        _history_cache.pop(thread_id)
         return True
 
     except Exception as e:
-        logger.error(f"Error deleting thread: {e}")
+        logger.error("Error deleting thread: %s", e)
         return False
 
 
 async def cleanup_old_conversations(days_old: int = 30):
     """Clean up conversations older than specified days"""
     try:
-        client = get_supabase_client()
-
-        cutoff_date = datetime.utcnow().replace(
+        cutoff_date = datetime.now(timezone.utc).replace(
             hour=0, minute=0, second=0, microsecond=0
         ) - timedelta(days=days_old)
 
-        # Delete old messages
-        client.table("messages").delete().lt(
-            "created_at", cutoff_date.isoformat()
-        ).execute()
+        async with get_pool().acquire() as conn:
+            async with conn.transaction():
+                # Delete old messages
+                await conn.execute(
+                    "DELETE FROM messages WHERE created_at < $1", cutoff_date
+                )
 
-        # Delete old threads
-        client.table("threads").delete().lt(
-            "last_activity", cutoff_date.isoformat()
-        ).execute()
+                # Delete old threads
+                await conn.execute(
+                    "DELETE FROM threads WHERE last_activity < $1", cutoff_date
+                )
 
-        logger.info(f"Cleaned up conversations older than {days_old} days")
+        _history_cache.clear()
+        logger.info("Cleaned up conversations older than %s days", days_old)
 
     except Exception as e:
-        logger.error(f"Error cleaning up conversations: {e}")
+        logger.error("Error cleaning up conversations: %s", e)
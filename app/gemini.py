@@ -1,12 +1,39 @@
 import google.generativeai as genai
+from app.cache import TTLCache
 from app.config import settings
 from app.models import ChatMessage, MessageRole
-from typing import List, AsyncGenerator, Dict, Any
+from typing import List, AsyncGenerator, Dict, Any, Optional
 import logging
 import asyncio
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
+_CODE_PATTERNS = [
+    r"``````",  # Code blocks
+    r"function\s+\w+\s*\(",  # Function definitions
+    r"class\s+\w+\s*[:\(]",  # Class definitions
+    r"def\s+\w+\s*\(",  # Python functions
+    r"const\s+\w+\s*=",  # JavaScript constants
+    r"let\s+\w+\s*=",  # JavaScript variables
+    r"var\s+\w+\s*=",  # JavaScript variables
+    r"#include\s*<",  # C/C++ includes
+    r"import\s+\w+",  # Import statements
+    r"from\s+\w+\s+import",  # Python imports
+]
+
+# One alternation compiled once instead of ten searches per chunk
+_ARTIFACT_RE = re.compile(
+    "|".join(f"(?:{pattern})" for pattern in _CODE_PATTERNS),
+    re.IGNORECASE | re.DOTALL,
+)
+_ARTIFACT_MIN_LENGTH = 6  # "``````", "let x=", "def f("
+
+# A turn stores the user message and the reply, so the thread's
+# message_count should move by exactly this much before the next turn
+_MESSAGES_PER_TURN = 2
+
 
 class GeminiClient:
     """Direct Gemini API client for text generation"""
@@ -24,6 +51,9 @@ class GeminiClient:
             Be concise but thorough in your explanations.
             If you generate code that could be used as an artifact, mention it clearly.""",
         )
+        # (session_id, thread_id) -> (ChatSession, expected message_count)
+        # from the thread's last turn
+        self._sessions = TTLCache(maxsize=settings.GEMINI_SESSION_CACHE_SIZE)
 
     def _prepare_conversation_history(
         self, messages: List[ChatMessage]
@@ -41,26 +71,43 @@ class GeminiClient:
 
     def _detect_code_artifact(self, content: str) -> bool:
         """Detect if content contains code artifacts"""
-        import re
-
-        code_patterns = [
-            r"``````",  # Code blocks
-            r"function\s+\w+\s*\(",  # Function definitions
-            r"class\s+\w+\s*[:\(]",  # Class definitions
-            r"def\s+\w+\s*\(",  # Python functions
-            r"const\s+\w+\s*=",  # JavaScript constants
-            r"let\s+\w+\s*=",  # JavaScript variables
-            r"var\s+\w+\s*=",  # JavaScript variables
-            r"#include\s*<",  # C/C++ includes
-            r"import\s+\w+",  # Import statements
-            r"from\s+\w+\s+import",  # Python imports
-        ]
-
-        for pattern in code_patterns:
-            if re.search(pattern, content, re.IGNORECASE | re.DOTALL):
-                return True
-
-        return False
+        # No pattern can match fewer characters than this
+        if len(content) < _ARTIFACT_MIN_LENGTH:
+            return False
+
+        return _ARTIFACT_RE.search(content) is not None
+
+    def _get_chat(
+        self,
+        key: tuple,
+        conversation_history: List[ChatMessage],
+        history_version: Optional[int],
+    ) -> genai.ChatSession:
+        """Reuse the thread's chat session if it matches the stored history"""
+        # Taken out of the cache so concurrent turns never share a session
+        entry = self._sessions.pop(key)
+        if entry is not None and history_version is not None:
+            chat, expected_version = entry
+            try:
+                # Writes elsewhere (another worker, a failed save, a deleted
+                # thread) move message_count off the expected value; the
+                # length and last message catch a trimmed or edited history
+                if (
+                    expected_version == history_version
+                    and len(chat.history) == len(conversation_history)
+                    and (
+                        not conversation_history
+                        or chat.history[-1].parts[0].text
+                        == conversation_history[-1].content
+                    )
+                ):
+                    return chat
+            except Exception as e:
+                logger.debug("Discarding chat session for %s: %s", key, e)
+
+        return self.model.start_chat(
+            history=self._prepare_conversation_history(conversation_history)
+        )
 
     async def stream_response(
         self,
@@ -68,24 +115,24 @@ class GeminiClient:
         conversation_history: List[ChatMessage],
         thread_id: str,
         session_id: str,
+        history_version: Optional[int] = None,
     ) -> AsyncGenerator[Dict[str, Any], None]:
-        """Stream response from Gemini API"""
+        """Stream response from Gemini API.
 
-        try:
-            # Prepare conversation history
-            history = self._prepare_conversation_history(conversation_history)
+        history_version is the thread's message_count the history was read
+        at; without it the chat session is never reused.
+        """
 
-            # Add current message
-            history.append({"role": "user", "parts": [current_message]})
+        key = (session_id, thread_id)
 
-            # Start chat with history
-            chat = self.model.start_chat(
-                history=history[:-1]
-            )  # Exclude current message
+        try:
+            # Continue the thread's chat, or start one from the stored history
+            chat = self._get_chat(key, conversation_history, history_version)
 
             # Generate streaming response
             full_response = ""
-            response_stream = chat.send_message(
+            # The async API reads the stream without blocking the event loop
+            response_stream = await chat.send_message_async(
                 current_message,
                 stream=True,
                 generation_config=genai.types.GenerationConfig(
@@ -96,21 +143,28 @@ class GeminiClient:
                 ),
             )
 
-            for chunk in response_stream:
+            async for chunk in response_stream:
                 if chunk.text:
                     full_response += chunk.text
 
-                    # Check for artifacts
-                    has_artifact = self._detect_code_artifact(chunk.text)
-
+                    # Artifacts are reported once, on the completion chunk
                     yield {
                         "type": "delta",
                         "content": chunk.text,
                         "thread_id": thread_id,
                         "session_id": session_id,
-                        "has_artifact": has_artifact,
+                        "has_artifact": False,
+                        "error_message": None,
                     }
 
+            # Only a fully consumed stream leaves the session reusable
+            if history_version is not None:
+                self._sessions.set(
+                    key,
+                    (chat, history_version + _MESSAGES_PER_TURN),
+                    time.time() + settings.GEMINI_SESSION_CACHE_TTL,
+                )
+
             # Send completion signal
             final_has_artifact = self._detect_code_artifact(full_response)
             yield {
@@ -119,10 +173,11 @@ class GeminiClient:
                 "thread_id": thread_id,
                 "session_id": session_id,
                 "has_artifact": final_has_artifact,
+                "error_message": None,
             }
 
         except Exception as e:
-            logger.error(f"Error in Gemini streaming: {e}")
+            logger.error("Error in Gemini streaming: %s", e)
             yield {
                 "type": "error",
                 "content": "",
@@ -1,6 +1,6 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List, Literal, Dict, Any
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
 from pydantic import EmailStr
 
@@ -14,10 +14,13 @@ class MessageRole(str, Enum):
 class ChatMessage(BaseModel):
     role: MessageRole
     content: str
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    id: Optional[str] = None
 
 
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     message: str = Field(..., min_length=1, max_length=50000)
     thread_id: str = Field(..., min_length=1, max_length=100)
     session_id: str = Field(..., min_length=1, max_length=100)
@@ -49,6 +52,8 @@ class ThreadSummary(BaseModel):
 
 
 class UserSignup(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     email: EmailStr = Field(..., description="User email address")
     password: str = Field(..., min_length=8, description="User password")
     full_name: str = Field(
@@ -58,6 +63,8 @@ class UserSignup(BaseModel):
 
 
 class UserLogin(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     email: EmailStr = Field(..., description="User email address")
     password: str = Field(..., description="User password")
 
@@ -75,31 +82,30 @@ class UserProfile(BaseModel):
     email: str
     full_name: Optional[str] = None
     username: Optional[str] = None
-    created_at: str
+    created_at: datetime
     email_verified: bool = False
 
 
 class PasswordChange(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     current_password: str = Field(..., description="Current password")
     new_password: str = Field(..., min_length=8, description="New password")
 
 
 class PasswordReset(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     email: EmailStr = Field(..., description="Email address to reset password")
 
 
 class EmailVerification(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     email: EmailStr = Field(..., description="Email address to verify")
     token: str = Field(..., description="Verification token")
 
 
-# Update existing ChatRequest to include user context
-class ChatRequest(BaseModel):
-    message: str = Field(..., min_length=1, max_length=50000)
-    thread_id: str = Field(..., min_length=1, max_length=100)
-    session_id: str = Field(..., min_length=1, max_length=100)
-
-
 class AuthenticatedChatRequest(ChatRequest):
     """Chat request that includes user authentication context"""
 
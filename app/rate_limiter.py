@@ -1,20 +1,116 @@
 import time
-from collections import defaultdict
-from typing import Dict, List
+from typing import Dict, Optional, Tuple
 from fastapi import HTTPException, Request
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from app.config import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shared counters so limits hold across workers; None means in-memory only
+redis_client: Optional[Redis] = None
+
+# Two-bucket sliding window, checked and incremented atomically in Redis.
+# KEYS: current window, previous window
+# ARGV: previous window weight, max requests, key ttl
+_SLIDING_WINDOW_LUA = """
+local curr = tonumber(redis.call('GET', KEYS[1]) or '0')
+local prev = tonumber(redis.call('GET', KEYS[2]) or '0')
+if prev * tonumber(ARGV[1]) + curr >= tonumber(ARGV[2]) then
+    return -1
+end
+curr = redis.call('INCR', KEYS[1])
+if curr == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return curr
+"""
+_sliding_window = None
+
+
+async def init_rate_limiter():
+    """Connect to Redis if configured, otherwise keep limits in memory"""
+    global redis_client, _sliding_window
+
+    if not settings.REDIS_URL or redis_client is not None:
+        return
+
+    client = Redis.from_url(
+        settings.REDIS_URL, socket_connect_timeout=1, socket_timeout=1
+    )
+    try:
+        await client.ping()
+    except RedisError as e:
+        logger.warning("Redis unavailable, using in-memory rate limits: %s", e)
+        await client.aclose()
+        return
+
+    redis_client = client
+    _sliding_window = client.register_script(_SLIDING_WINDOW_LUA)
+    logger.info("Rate limiter using Redis")
+
+
+async def close_rate_limiter():
+    """Close the Redis connection pool"""
+    global redis_client, _sliding_window
+
+    if redis_client is None:
+        return
+
+    try:
+        await redis_client.aclose()
+    except RedisError as e:
+        logger.error("Error closing Redis client: %s", e)
+    finally:
+        redis_client = None
+        _sliding_window = None
+
+
+def get_redis() -> Optional[Redis]:
+    """The shared Redis client, or None when running in-memory only"""
+    return redis_client
+
+
+async def _check_shared_limit(
+    scope: str, identifier: str, max_requests: int, window_size: int
+) -> Optional[bool]:
+    """Count a request in Redis; None when Redis can't be used"""
+    if redis_client is None:
+        return None
+
+    # Wall-clock windows so every worker agrees on the window boundaries
+    window, elapsed = divmod(time.time(), window_size)
+    key = f"rl:{scope}:{identifier}:"
+
+    try:
+        count = await _sliding_window(
+            keys=[key + str(int(window)), key + str(int(window) - 1)],
+            args=[1 - elapsed / window_size, max_requests, 2 * window_size],
+        )
+    except RedisError as e:
+        logger.warning("Redis rate limit check failed, using in-memory: %s", e)
+        return None
+
+    return count >= 0
+
 
 class RateLimiter:
-    """Simple in-memory rate limiter"""
+    """Simple in-memory rate limiter.
+
+    Uses a two-bucket sliding window: the count for the current fixed window
+    plus the previous window's count weighted by how much of it still
+    overlaps the sliding window. Each client costs one tuple, whatever its
+    request rate.
+    """
 
     def __init__(self):
-        self.requests: Dict[str, List[float]] = defaultdict(list)
+        # client_id -> (window index, previous window count, current count)
+        self.buckets: Dict[str, Tuple[int, int, int]] = {}
         self.max_requests = settings.RATE_LIMIT_REQUESTS
         self.window_size = settings.RATE_LIMIT_WINDOW
+        self.window_ns = self.window_size * 1_000_000_000
+        self._swept_window = 0
 
     def _get_client_id(self, request: Request) -> str:
         """Get client identifier for rate limiting"""
@@ -26,39 +122,158 @@ class RateLimiter:
         # Fall back to direct client host
         return request.client.host or "unknown"
 
-    def _clean_old_requests(self, client_id: str):
-        """Remove requests older than the window"""
-        current_time = time.time()
-        cutoff_time = current_time - self.window_size
+    def _limit_exceeded(self, client_id: str) -> HTTPException:
+        """Build the 429 response for a client over its limit"""
+        logger.warning("Rate limit exceeded for client: %s", client_id)
+        return HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded. Maximum {self.max_requests} requests per {self.window_size} seconds.",
+            headers={"Retry-After": str(self.window_size)},
+        )
 
-        self.requests[client_id] = [
-            req_time for req_time in self.requests[client_id] if req_time > cutoff_time
-        ]
+    def _clean_old_requests(self, window: int):
+        """Drop clients idle for two or more windows, once per window"""
+        if window == self._swept_window:
+            return
+
+        self._swept_window = window
+        self.buckets = {
+            client_id: bucket
+            for client_id, bucket in self.buckets.items()
+            if bucket[0] >= window - 1
+        }
 
     async def check_rate_limit(self, request: Request):
         """Check if request should be rate limited"""
         client_id = self._get_client_id(request)
-        current_time = time.time()
 
-        # Clean old requests
-        self._clean_old_requests(client_id)
+        allowed = await _check_shared_limit(
+            "ip", client_id, self.max_requests, self.window_size
+        )
+        if allowed is not None:
+            if not allowed:
+                raise self._limit_exceeded(client_id)
+            return
+
+        current_time = time.monotonic_ns()
+        window, elapsed = divmod(current_time, self.window_ns)
+
+        self._clean_old_requests(window)
+
+        start, prev_count, curr_count = self.buckets.get(client_id, (window, 0, 0))
+        if window == start + 1:
+            prev_count, curr_count = curr_count, 0
+        elif window != start:
+            prev_count, curr_count = 0, 0
+
+        # prev * (1 - elapsed / window) + curr, kept in integer nanoseconds
+        weighted = prev_count * (self.window_ns - elapsed) + curr_count * self.window_ns
 
         # Check if over limit
-        if len(self.requests[client_id]) >= self.max_requests:
-            logger.warning(f"Rate limit exceeded for client: {client_id}")
-            raise HTTPException(
-                status_code=429,
-                detail=f"Rate limit exceeded. Maximum {self.max_requests} requests per {self.window_size} seconds.",
-                headers={"Retry-After": str(self.window_size)},
-            )
+        if weighted >= self.max_requests * self.window_ns:
+            self.buckets[client_id] = (window, prev_count, curr_count)
+            raise self._limit_exceeded(client_id)
 
         # Add current request
-        self.requests[client_id].append(current_time)
+        self.buckets[client_id] = (window, prev_count, curr_count + 1)
 
         logger.debug(
-            f"Rate limit check passed for {client_id}: {len(self.requests[client_id])}/{self.max_requests}"
+            "Rate limit check passed for %s: %s/%s",
+            client_id,
+            curr_count + 1,
+            self.max_requests,
+        )
+
+
+# Token bucket layout: timestamp_ms << TOKEN_BITS | tokens
+TOKEN_BITS = 16
+TOKEN_MASK = (1 << TOKEN_BITS) - 1
+
+
+def _refill(bucket: int, now_ms: int, refill_ms: int, burst: int) -> int:
+    """Return the packed bucket topped up with the tokens earned since its timestamp"""
+    ts_ms = bucket >> TOKEN_BITS
+    refill = (now_ms - ts_ms) // refill_ms
+    if not refill:
+        return bucket
+
+    tokens = (bucket & TOKEN_MASK) + refill
+    if tokens >= burst:
+        return now_ms << TOKEN_BITS | burst
+
+    # Only advance by whole tokens so partial progress is kept
+    return (ts_ms + refill * refill_ms) << TOKEN_BITS | tokens
+
+
+class UserRateLimiter:
+    """In-memory per-user token bucket.
+
+    Each bucket is a single int packing ``timestamp_ms << 16 | tokens`` so a
+    check is one dict lookup plus integer arithmetic, with no per-request
+    allocations beyond the int itself.
+    """
+
+    def __init__(self):
+        self.buckets: Dict[str, int] = {}
+        self.burst = min(settings.RATE_LIMIT_REQUESTS, TOKEN_MASK)
+        self.window_size = settings.RATE_LIMIT_WINDOW
+        # Milliseconds it takes to earn back one token
+        self.refill_ms = max(1, self.window_size * 1000 // self.burst)
+        self._swept_at_ms = 0
+
+    def _drop_full_buckets(self, now_ms: int):
+        """Drop buckets that have refilled completely, at most once per window"""
+        if now_ms - self._swept_at_ms < self.window_size * 1000:
+            return
+
+        # A full bucket behaves exactly like a missing one
+        self._swept_at_ms = now_ms
+        self.buckets = {
+            identifier: bucket
+            for identifier, bucket in self.buckets.items()
+            if _refill(bucket, now_ms, self.refill_ms, self.burst) & TOKEN_MASK
+            < self.burst
+        }
+
+    async def check_rate_limit(self, identifier: str):
+        """Take one token from the identifier's bucket or raise 429"""
+        allowed = await _check_shared_limit(
+            "user", identifier, self.burst, self.window_size
         )
+        if allowed is not None:
+            if not allowed:
+                logger.warning("Rate limit exceeded for user: %s", identifier)
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Rate limit exceeded. Maximum {self.burst} requests per {self.window_size} seconds.",
+                    headers={"Retry-After": str(self.window_size)},
+                )
+            return
+
+        now_ms = time.monotonic_ns() // 1_000_000
+        self._drop_full_buckets(now_ms)
+        bucket = self.buckets.get(identifier)
+
+        if bucket is None:
+            bucket = now_ms << TOKEN_BITS | self.burst
+        else:
+            bucket = _refill(bucket, now_ms, self.refill_ms, self.burst)
+
+        if not bucket & TOKEN_MASK:
+            self.buckets[identifier] = bucket
+            next_token_ms = (bucket >> TOKEN_BITS) + self.refill_ms
+            retry_after = -(-(next_token_ms - now_ms) // 1000)
+            logger.warning("Rate limit exceeded for user: %s", identifier)
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded. Maximum {self.burst} requests per {self.window_size} seconds.",
+                headers={"Retry-After": str(retry_after)},
+            )
+
+        # Tokens live in the low bits, so spending one is a plain decrement
+        self.buckets[identifier] = bucket - 1
 
 
-# Global rate limiter instance
+# Global rate limiter instances
 # rate_limiter = RateLimiter()
+user_rate_limiter = UserRateLimiter()
@@ -1,14 +1,21 @@
 from fastapi.responses import StreamingResponse
 from app.models import ChatRequest, StreamChunk
+from app.config import settings
 from app.gemini import gemini_client
-from app.db import get_conversation_history, save_message
+from app.db import get_prompt_history, normalize_thread_id, save_message
 from app.models import MessageRole
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Set
+import asyncio
 import json
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Strong references to in-flight saves so they finish even if the client
+# disconnects and the stream is closed before awaiting them
+_pending_saves: Set[asyncio.Task] = set()
+
 
 class StreamingService:
     """Handle Server-Sent Events streaming for chat responses"""
@@ -16,46 +23,64 @@ class StreamingService:
     @staticmethod
     async def stream_chat_response(
         request: ChatRequest, user_id: str
-    ) -> AsyncGenerator[str, None]:
+    ) -> AsyncGenerator[bytes, None]:
         """Stream chat response using Server-Sent Events format"""
 
+        # Both sides of the conversation are stored under one thread id
+        thread_id = normalize_thread_id(request.thread_id)
+
         try:
             # Get conversation history
-            history = await get_conversation_history(request.thread_id)
-
-            if not request.thread_id.startswith("req"):
-                thread_id = f"req_{request.thread_id}"
-            # Save user message
-            await save_message(
+            history, history_version = await get_prompt_history(
                 thread_id,
-                request.session_id,
-                MessageRole.USER,
-                request.message,
                 user_id,
+                settings.MAX_CONVERSATION_LENGTH,
+                settings.HISTORY_TOKEN_BUDGET,
             )
 
+            # Save user message while Gemini works on its first tokens
+            user_save = asyncio.create_task(
+                save_message(
+                    thread_id,
+                    request.session_id,
+                    MessageRole.USER,
+                    request.message,
+                    user_id,
+                )
+            )
+            _pending_saves.add(user_save)
+            user_save.add_done_callback(_pending_saves.discard)
+
             # Stream response from Gemini
             full_response = ""
             async for chunk_data in gemini_client.stream_response(
-                request.message, history, request.thread_id, request.session_id
+                request.message,
+                history,
+                request.thread_id,
+                request.session_id,
+                history_version,
             ):
-
-                # Create stream chunk
-                chunk = StreamChunk(**chunk_data)
+                chunk_type = chunk_data["type"]
 
                 # Accumulate response for saving
-                if chunk.type == "delta" and chunk.content:
-                    full_response += chunk.content
+                if chunk_type == "delta" and chunk_data["content"]:
+                    full_response += chunk_data["content"]
 
-                # Format as Server-Sent Event
-                yield f"data: {chunk.model_dump_json()}\n\n"
+                # Format as Server-Sent Event; the dict already has the
+                # StreamChunk shape, so it skips model validation
+                yield b"data: " + orjson.dumps(chunk_data) + b"\n\n"
 
                 # Handle completion
-                if chunk.type == "completion":
+                if chunk_type == "completion":
+                    # Keep the user message ahead of the reply in the thread;
+                    # if it wasn't saved (e.g. someone else's thread), neither
+                    # is the reply
+                    user_saved = await user_save
+
                     # Save assistant response
-                    if full_response:
+                    if user_saved and full_response:
                         await save_message(
-                            request.thread_id,
+                            thread_id,
                             request.session_id,
                             MessageRole.ASSISTANT,
                             full_response,
@@ -64,12 +89,12 @@ class StreamingService:
                     break
 
                 # Handle errors
-                elif chunk.type == "error":
-                    logger.error(f"Streaming error: {chunk.error_message}")
+                elif chunk_type == "error":
+                    logger.error("Streaming error: %s", chunk_data["error_message"])
                     break
 
         except Exception as e:
-            logger.error(f"Error in streaming service: {e}")
+            logger.error("Error in streaming service: %s", e)
 
             # Send error chunk
             error_chunk = StreamChunk(
@@ -80,7 +105,7 @@ class StreamingService:
                 has_artifact=False,
                 error_message=str(e),
             )
-            yield f"data: {error_chunk.model_dump_json()}\n\n"
+            yield b"data: " + error_chunk.model_dump_json().encode() + b"\n\n"
 
     @staticmethod
     def create_streaming_response(
@@ -95,7 +120,5 @@ class StreamingService:
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
                 "X-Accel-Buffering": "no",  # Disable nginx buffering
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "Cache-Control",
             },
         )
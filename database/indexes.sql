@@ -0,0 +1,11 @@
+-- Indexes for the chat queries in app/db.py
+-- CONCURRENTLY avoids locking writes but cannot run inside a transaction,
+-- so run each statement on its own (not as one multi-statement batch).
+
+-- History reads filter by thread_id and read newest-first by created_at
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_thread_id_created_at
+    ON messages(thread_id, created_at);
+
+-- Thread listings filter by user_id and order by last_activity
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_threads_user_id_last_activity
+    ON threads(user_id, last_activity DESC);
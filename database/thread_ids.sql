@@ -0,0 +1,21 @@
+-- One-off migration: store every message under its normalized thread id
+-- Assistant replies used to be saved under the raw client thread id while
+-- user messages got the "req_" prefix, splitting each conversation across
+-- two threads. Run once before deploying the code that reads only the
+-- normalized id (see normalize_thread_id in app/db.py).
+BEGIN;
+
+UPDATE messages
+SET thread_id = 'req_' || thread_id
+WHERE thread_id NOT LIKE 'req%';
+
+-- The unprefixed "mirror" threads now have no messages
+DELETE FROM threads
+WHERE thread_id NOT LIKE 'req%';
+
+UPDATE threads t
+SET message_count = (
+    SELECT count(*) FROM messages m WHERE m.thread_id = t.thread_id
+);
+
+COMMIT;
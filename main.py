@@ -1,15 +1,18 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 from app.config import settings
-from app.db import init_database
+from app.db import init_database, close_database
+from app.rate_limiter import init_rate_limiter, close_rate_limiter
 from app.chat import router as chat_router
 from app.auth import router as auth_router  # NEW
 import logging
 
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    level=settings.LOG_LEVEL,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
 )
 logger = logging.getLogger(__name__)
 
@@ -20,9 +23,12 @@ async def lifespan(app: FastAPI):
     # Startup
     await init_database()
     logger.info("Database initialized")
+    await init_rate_limiter()
     yield
     # Shutdown
     logger.info("Application shutting down")
+    await close_rate_limiter()
+    await close_database()
 
 
 app = FastAPI(
@@ -30,21 +36,19 @@ app = FastAPI(
     description="Claude-style AI coding assistant with authentication and streaming responses",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # CORS middleware
+# Explicit origins and headers: a "*" origin can't carry credentials, and
+# max_age lets browsers cache the preflight instead of repeating it
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:3000",
-        "http://localhost:5173",
-        "http://127.0.0.1:3000",
-        "http://127.0.0.1:5173",
-        "*",
-    ],
+    allow_origins=settings.CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Authorization", "Content-Type", "Accept", "Cache-Control"],
+    max_age=86400,
 )
 
 # Include routers